@@ -1,10 +1,21 @@
 import os
+import re
+import time
+import functools
+import random
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import google.generativeai as genai
+from google.api_core.exceptions import ResourceExhausted
 from dotenv import load_dotenv
 from flask import Flask, request, jsonify
 from telegram import Update, Bot
+from telegram.error import TelegramError
+from telegram.utils.request import Request
 from telegram.ext import Dispatcher, CommandHandler, MessageHandler, Filters, CallbackContext
 
 # Load environment variables
@@ -19,11 +30,41 @@ if GEMINI_API_KEY:
     genai.configure(api_key=GEMINI_API_KEY)
     model = genai.GenerativeModel('gemini-1.5-flash')
 
+# Cap concurrent Gemini requests so bursts don't run into the rate limit
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", 5))
+GEMINI_MAX_RETRIES = 3
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", 15))
+GEMINI_ACQUIRE_TIMEOUT = float(os.getenv("GEMINI_ACQUIRE_TIMEOUT", 10))
+GEMINI_SEM = threading.BoundedSemaphore(GEMINI_MAX_CONCURRENCY)
+
+# Background pool for fire-and-forget Telegram replies. Its size caps how many
+# placeholders go out at once; the bot's connection pool below is sized to match
+REPLY_MAX_WORKERS = int(os.getenv("REPLY_MAX_WORKERS", 32))
+REPLY_EXECUTOR = ThreadPoolExecutor(max_workers=REPLY_MAX_WORKERS)
+
+# ISO 3779 VIN format: 17 characters, no I, O or Q
+VIN_RE = re.compile(r'[A-HJ-NPR-Z0-9]{17}')
+VIN_TRANSLITERATION = {
+    **{str(d): d for d in range(10)},
+    'A': 1, 'B': 2, 'C': 3, 'D': 4, 'E': 5, 'F': 6, 'G': 7, 'H': 8,
+    'J': 1, 'K': 2, 'L': 3, 'M': 4, 'N': 5, 'P': 7, 'R': 9,
+    'S': 2, 'T': 3, 'U': 4, 'V': 5, 'W': 6, 'X': 7, 'Y': 8, 'Z': 9,
+}
+VIN_WEIGHTS = (8, 7, 6, 5, 4, 3, 2, 10, 0, 9, 8, 7, 6, 5, 4, 3, 2)
+
+# Shared HTTP session so NHTSA lookups reuse a pooled keep-alive connection
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=Retry(total=2, backoff_factor=0.2))
+)
+
 # Flask app for webhook
 app = Flask(__name__)
 
-# Initialize bot and dispatcher
-bot = Bot(token=TOKEN)
+# Initialize bot and dispatcher, with enough pooled connections for concurrent
+# background replies plus the webhook threads' own replies
+bot = Bot(token=TOKEN, request=Request(con_pool_size=REPLY_MAX_WORKERS + 4))
 dispatcher = Dispatcher(bot, None, workers=0, use_context=True)
 
 logging.basicConfig(
@@ -53,12 +94,52 @@ def checkvin(update: Update, context: CallbackContext):
 
 def handle_message(update: Update, context: CallbackContext):
     if context.user_data.get("expecting_vin"):
-        vin = update.message.text.strip()
+        vin = update.message.text.strip().upper()
         context.user_data["expecting_vin"] = False
         send_vin_info(update, vin)
     else:
         update.message.reply_text("How may I help you?\nUse /checkvin to decode a VIN.")
 
+def generate_with_limit(prompt: str):
+    """
+    Call Gemini with bounded concurrency, backing off and retrying on rate limits
+    """
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        # Don't block the webhook thread indefinitely when every slot is busy
+        if not GEMINI_SEM.acquire(timeout=GEMINI_ACQUIRE_TIMEOUT):
+            raise ValueError("Timed out waiting for a free Gemini slot")
+        try:
+            return model.generate_content(prompt, request_options={"timeout": GEMINI_TIMEOUT})
+        except ResourceExhausted:
+            if attempt == GEMINI_MAX_RETRIES:
+                raise
+            delay = 2 ** attempt + random.uniform(0, 1)
+            logger.warning("Gemini rate limited, retrying in %.1fs", delay)
+        finally:
+            GEMINI_SEM.release()
+        time.sleep(delay)
+
+@functools.lru_cache(maxsize=4096)
+def _query_fuel_capacity(make: str, model_name: str, year: str):
+    """
+    Ask Gemini for the fuel tank capacity, memoized per (make, model, year)
+    """
+    prompt = f"What is the fuel tank capacity in gallons for a {year} {make} {model_name}? Please provide only the numerical value followed by 'gallons'. If there are multiple trim levels with different capacities, provide the most common capacity or a range."
+    
+    logger.info("Querying Gemini for: %s %s %s", year, make, model_name)
+    
+    response = generate_with_limit(prompt)
+    
+    logger.debug("Gemini response object: %r", response)
+    
+    if response and hasattr(response, 'text') and response.text:
+        logger.info("Gemini response text: %s", response.text)
+        return response.text.strip()
+    
+    # Raise instead of returning so failed lookups are not cached
+    logger.debug("Empty or invalid Gemini response: %r", response)
+    raise ValueError("Empty or invalid response from Gemini")
+
 def get_fuel_capacity_from_gemini(make: str, model_name: str, year: str):
     """
     Query Gemini API for fuel tank capacity
@@ -69,48 +150,86 @@ def get_fuel_capacity_from_gemini(make: str, model_name: str, year: str):
     if not model:
         return "Gemini model not initialized"
     
+    # Normalize the key so the same vehicle always hits the cache
+    make, model_name, year = make.strip().upper(), model_name.strip().upper(), year.strip()
+    if not make or not model_name or not year:
+        return "Unable to retrieve fuel capacity from AI"
+    
     try:
-        prompt = f"What is the fuel tank capacity in gallons for a {year} {make} {model_name}? Please provide only the numerical value followed by 'gallons'. If there are multiple trim levels with different capacities, provide the most common capacity or a range."
-        
-        logger.info(f"Querying Gemini for: {year} {make} {model_name}")
-        
-        response = model.generate_content(prompt)
-        
-        logger.info(f"Gemini response object: {response}")
-        
-        if response and hasattr(response, 'text') and response.text:
-            logger.info(f"Gemini response text: {response.text}")
-            return response.text.strip()
-        else:
-            logger.warning(f"Empty or invalid response from Gemini: {response}")
-            return "Unable to retrieve fuel capacity from AI"
-            
+        return _query_fuel_capacity(make, model_name, year)
+    except ValueError as e:
+        # Blocked or empty responses are not cached, so the next lookup retries Gemini
+        logger.warning("%s", e)
+        return "Unable to retrieve fuel capacity from AI"
     except Exception as e:
-        logger.error(f"Error querying Gemini API: {e}")
-        logger.error(f"Error type: {type(e)}")
+        logger.error("Error querying Gemini API (%s): %s", type(e).__name__, e)
         return f"Error retrieving fuel capacity: {str(e)}"
 
-def send_vin_info(update: Update, vin: str):
-    # Show "typing" indicator while processing
-    update.message.reply_text("🔍 Decoding VIN and looking up fuel capacity...")
+def valid_vin(vin: str) -> bool:
+    """
+    Check VIN length and character set, plus the check digit at position 9
+    for North American VINs (WMI starting with 1-5), the only ones that require it
+    """
+    if not VIN_RE.fullmatch(vin):
+        return False
     
+    if vin[0] not in "12345":
+        return True
+    
+    total = sum(VIN_TRANSLITERATION[c] * w for c, w in zip(vin, VIN_WEIGHTS))
+    remainder = total % 11
+    check_digit = 'X' if remainder == 10 else str(remainder)
+    return vin[8] == check_digit
+
+@functools.lru_cache(maxsize=4096)
+def decode_vin(vin: str):
+    """
+    Decode a VIN into (make, model, year) via NHTSA, memoized per VIN
+    """
     url = f"https://vpic.nhtsa.dot.gov/api/vehicles/decodevinvalues/{vin}?format=json"
-    try:
-        response = requests.get(url)
-        data = response.json()
-        result = data["Results"][0]
+    response = SESSION.get(url, timeout=10)
+    data = response.json()
+    result = data["Results"][0]
+
+    # NHTSA always returns these keys but leaves them blank when it can't decode
+    make = (result.get("Make") or "").strip()
+    model_car = (result.get("Model") or "").strip()
+    year = (result.get("ModelYear") or "").strip()
+
+    logger.info("NHTSA decoded - Make: %s, Model: %s, Year: %s", make, model_car, year)
 
-        make = result.get("Make", "N/A")
-        model_car = result.get("Model", "N/A")
-        year = result.get("ModelYear", "N/A")
+    # Raise instead of returning so failed decodes are not cached
+    if not make or not model_car or not year:
+        logger.warning("VIN decoding failed for %s", vin)
+        logger.debug("Raw NHTSA result: %r", result)
+        raise ValueError(f"Unable to decode VIN {vin}")
 
-        logger.info(f"NHTSA decoded - Make: {make}, Model: {model_car}, Year: {year}")
+    return make, model_car, year
 
-        # Check if VIN decoding was successful
-        if make == "N/A" or model_car == "N/A" or year == "N/A":
-            logger.warning(f"VIN decoding failed. Raw result: {result}")
-            update.message.reply_text(" Invalid VIN or unable to decode. Please check the VIN and try again.")
-            return
+def log_reply_failure(future):
+    """
+    Log errors from background replies, which would otherwise be dropped
+    """
+    if not future.cancelled() and future.exception():
+        logger.warning("Failed to send placeholder reply: %s", future.exception())
+
+def send_vin_info(update: Update, vin: str):
+    # Reject malformed VINs before spending an NHTSA or Gemini call on them
+    if not valid_vin(vin):
+        update.message.reply_text(" Invalid VIN. A VIN is 17 letters and digits (no I, O or Q), and North American VINs need a valid check digit. Please check the VIN and try again.")
+        return
+    
+    # Send the "typing" placeholder in the background so the NHTSA lookup starts right away
+    placeholder = REPLY_EXECUTOR.submit(update.message.reply_text, "🔍 Decoding VIN and looking up fuel capacity...")
+    placeholder.add_done_callback(log_reply_failure)
+    
+    def reply(text: str, **kwargs):
+        # Keep the placeholder ahead of the final answer in the chat
+        wait([placeholder])
+        update.message.reply_text(text, **kwargs)
+    
+    try:
+        make, model_car, year = decode_vin(vin)
 
         # Get fuel capacity from Gemini API
         fuel_capacity = get_fuel_capacity_from_gemini(make, model_car, year)
@@ -125,14 +244,16 @@ def send_vin_info(update: Update, vin: str):
             f"**Fuel Tank Capacity:** {fuel_capacity}"
         )
         
-        update.message.reply_text(response_text, parse_mode='Markdown')
+        reply(response_text, parse_mode='Markdown')
         
     except requests.RequestException as e:
-        logger.error(f"Error contacting NHTSA API: {e}")
-        update.message.reply_text(" Sorry, there was an error contacting the VIN database. Please try again later.")
+        logger.error("Error contacting NHTSA API: %s", e)
+        reply(" Sorry, there was an error contacting the VIN database. Please try again later.")
+    except ValueError:
+        reply(" Invalid VIN or unable to decode. Please check the VIN and try again.")
     except Exception as e:
-        logger.error(f"Error decoding VIN: {e}")
-        update.message.reply_text(" Sorry, something went wrong while decoding the VIN.")
+        logger.error("Error decoding VIN: %s", e)
+        reply(" Sorry, something went wrong while decoding the VIN.")
 
 # Add handlers to dispatcher
 dispatcher.add_handler(CommandHandler("start", start))
@@ -153,7 +274,7 @@ def webhook():
         dispatcher.process_update(update)
         return jsonify({'status': 'ok'})
     except Exception as e:
-        logger.error(f"Error processing webhook: {e}")
+        logger.error("Error processing webhook: %s", e)
         return jsonify({'status': 'error'}), 500
 
 @app.route('/set_webhook')
@@ -186,4 +307,16 @@ def webhook_info():
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))
+    
+    # Register the webhook on startup instead of relying on a manual /set_webhook call
+    if WEBHOOK_URL:
+        try:
+            if bot.set_webhook(url=f"{WEBHOOK_URL}/webhook"):
+                logger.info("Webhook set to %s/webhook", WEBHOOK_URL)
+            else:
+                logger.warning("Failed to set webhook on startup")
+        except TelegramError as e:
+            # Keep serving so /set_webhook can be retried manually
+            logger.warning("Failed to set webhook on startup: %s", e)
+    
     app.run(host="0.0.0.0", port=port, debug=False)
\ No newline at end of file